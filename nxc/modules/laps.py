@@ -1,7 +1,7 @@
 import json
 
 from impacket.ldap import ldapasn1 as ldapasn1_impacket
-from nxc.protocols.ldap.laps import LAPSv2Extract
+from nxc.protocols.ldap.laps import LAPSv2BatchExtract
 
 
 class NXCModule:
@@ -39,20 +39,12 @@ class NXCModule:
         results = [r for r in results if isinstance(r, ldapasn1_impacket.SearchResultEntry)]
         if len(results) != 0:
             laps_computers = []
+            encrypted_computers = []
             for computer in results:
-                msMCSAdmPwd = ""
-                sAMAccountName = ""
                 values = {str(attr["type"]).lower(): attr["vals"][0] for attr in computer["attributes"]}
                 if "mslaps-encryptedpassword" in values:
-                    msMCSAdmPwd = values["mslaps-encryptedpassword"]
-                    d = LAPSv2Extract(bytes(msMCSAdmPwd), connection.username if connection.username else "", connection.password if connection.password else "", connection.domain, connection.nthash if connection.nthash else "", connection.kerberos, connection.kdcHost, 339, connection.dns_server)
-                    try:
-                        data = d.run()
-                    except Exception as e:
-                        context.log.fail(str(e))
-                        continue
-                    r = json.loads(data)
-                    laps_computers.append((str(values["samaccountname"]), r["n"], str(r["p"])))
+                    # Decrypted together below so that all blobs share one MS-GKDI connection and GetKey results
+                    encrypted_computers.append((str(values["samaccountname"]), bytes(values["mslaps-encryptedpassword"])))
                 elif "mslaps-password" in values:
                     r = json.loads(str(values["mslaps-password"]))
                     laps_computers.append((str(values["samaccountname"]), r["n"], str(r["p"])))
@@ -61,6 +53,14 @@ class NXCModule:
                 else:
                     context.log.fail("No result found with attribute ms-MCS-AdmPwd or msLAPS-Password")
 
+            if encrypted_computers:
+                d = LAPSv2BatchExtract(connection.username if connection.username else "", connection.password if connection.password else "", connection.domain, connection.nthash if connection.nthash else "", connection.kerberos, connection.kdcHost, 339, connection.dns_server)
+                for (sAMAccountName, _), data in zip(encrypted_computers, d.decrypt_many([blob for _, blob in encrypted_computers]), strict=True):
+                    if data is None:
+                        continue
+                    r = json.loads(data)
+                    laps_computers.append((sAMAccountName, r["n"], str(r["p"])))
+
             laps_computers = sorted(laps_computers, key=lambda x: x[0])
             for sAMAccountName, user, password in laps_computers:
                 context.log.highlight(f"Computer:{sAMAccountName} User:{user:<15} Password:{password}")
@@ -1,14 +1,19 @@
+import math
+import queue
+import re
+import struct
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from functools import cache, lru_cache
 from json import loads
-from pyasn1.codec.der import decoder
-from pyasn1_modules import rfc5652
+from weakref import WeakKeyDictionary
 
+# Only what LDAPConnect needs is imported here, the LAPSv2 decryption dependencies are imported
+# where they are used so that credential checks do not pay for them
 from impacket.ldap import ldap as ldap_impacket
-from impacket.krb5.kerberosv5 import KerberosError
-from impacket.dcerpc.v5 import transport
-from impacket.dcerpc.v5.epm import hept_map
-from impacket.dcerpc.v5.gkdi import MSRPC_UUID_GKDI, GkdiGetKey, GroupKeyEnvelope
-from impacket.dcerpc.v5.rpcrt import RPC_C_AUTHN_LEVEL_PKT_INTEGRITY, RPC_C_AUTHN_LEVEL_PKT_PRIVACY
-from impacket.dpapi_ng import EncryptedPasswordBlob, KeyIdentifier, compute_kek, create_sd, decrypt_plaintext, unwrap_cek
+from impacket.ldap import ldapasn1 as ldapasn1_impacket
 
 from nxc.logger import NXCAdapter
 
@@ -26,39 +31,296 @@ ldap_error_status = {
     "KDC_ERR_PREAUTH_FAILED": "KDC_ERR_PREAUTH_FAILED",
 }
 
+# Bind failures end with "..., data <code>, v<build>", the code being a hex Win32 error
+_LDAP_ERROR_CODE_RE = re.compile(r"data ([0-9a-fA-F]+)")
+_LDAP_ERROR_INT = {int(error_code, 16): (status, "magenta") for error_code, status in ldap_error_status.items() if error_code.isdigit()}
+_LDAP_ERROR_STR = {error_code: (status, "magenta") for error_code, status in ldap_error_status.items() if not error_code.isdigit()}
+
+# Authenticated LDAP connections kept warm for reuse, keyed by target and credential
+_LDAP_POOL = {}
+_LDAP_POOL_LOCK = threading.Lock()
+
+# Bound MS-GKDI connections, keyed by target and credential, stored as (dce, lock). GetKey
+# calls on a shared connection must not interleave, so they run under that connection's lock
+_GKDI_DCE_CACHE = {}
+_GKDI_DCE_CACHE_LOCK = threading.Lock()
+
+
+@cache
+def _der_decoder():
+    """Return pyasn1-fasder's Rust-backed decoder when it is installed, pyasn1's DER decoder otherwise"""
+    try:
+        from pyasn1_fasder import decode_der
+    except ImportError:
+        from pyasn1.codec.der.decoder import decode as decode_der
+    return decode_der
+
+
+def _der_decode(substrate, asn1Spec):
+    """Decode a DER substrate against asn1Spec, using pyasn1-fasder when available
+
+    pyasn1-fasder rejects trailing octets, so substrate must contain exactly one encoded value
+    """
+    return _der_decoder()(bytes(substrate), asn1Spec=asn1Spec)
+
+
+def _is_transport_failure(e):
+    """Whether an exception raised by an RPC call means the connection itself is gone
+
+    DCERPCSessionError and RPC faults are answers from the server, the connection is still usable after them
+    """
+    from impacket.dcerpc.v5.rpcrt import DCERPCException
+
+    if isinstance(e, OSError):
+        return True
+    return type(e) is DCERPCException and "Connection closed" in str(e)
+
+
+@lru_cache(maxsize=64)
+def _cached_hept_map(dest_host, remote_if):
+    """Resolve the ncacn_ip_tcp endpoint of remote_if on dest_host through the endpoint mapper"""
+    from impacket.dcerpc.v5.epm import hept_map
+
+    return hept_map(destHost=dest_host, remoteIf=remote_if, protocol="ncacn_ip_tcp")
+
+
+def _build_transport(string_binding, username, password, domain, lmhash, nthash, do_kerberos, kdcHost):
+    """Create an RPC transport for string_binding with the credentials already set"""
+    from impacket.dcerpc.v5 import transport
+
+    rpc_transport = transport.DCERPCTransportFactory(string_binding)
+    if hasattr(rpc_transport, "set_credentials"):
+        rpc_transport.set_credentials(username=username, password=password, domain=domain, lmhash=lmhash, nthash=nthash)
+    if do_kerberos:
+        rpc_transport.set_kerberos(do_kerberos, kdcHost=kdcHost)
+    return rpc_transport
+
+
+@lru_cache(maxsize=256)
+def _base_dn(domain):
+    """Build the LDAP base DN for a domain, e.g. corp.local -> dc=corp,dc=local"""
+    return ",".join(f"dc={part}" for part in domain.split("."))
+
+
+@lru_cache(maxsize=256)
+def _parse_ntlm_hash(ntlm_hash):
+    """Split an NTLM hash into (lmhash, nthash), the LM part being optional"""
+    lmhash, sep, nthash = ntlm_hash.partition(":")
+    if sep:
+        return lmhash, nthash
+    return "", lmhash
+
+
+def _stronger_auth_required(e):
+    """Whether the DC rejected the bind until it happens over LDAPS (LDAP resultCode 8, strongerAuthRequired)
+
+    impacket only fills the error code for some failures, bind errors just carry the result code name in their message
+    """
+    return e.getErrorCode() == 8 or "strongerAuthRequired" in e.getErrorString()
+
+
+def _ldap_error_status(error_string):
+    """Map an LDAP bind error message to the (status, color) used to report the failure"""
+    match = _LDAP_ERROR_CODE_RE.search(error_string)
+    error_code = match.group(1) if match else error_string.rsplit(None, 2)[-2][:-1]
+    try:
+        return _LDAP_ERROR_INT.get(int(error_code, 16), ("", "red"))
+    except ValueError:
+        return _LDAP_ERROR_STR.get(error_code, ("", "red"))
+
+
+def _read_tlv(buf, off):
+    """Read the DER TLV header at off and return (tag, length, value_off, next_off)"""
+    try:
+        tag, length = struct.unpack_from(">BB", buf, off)
+    except struct.error as e:
+        raise ValueError(f"Truncated DER header at offset {off}") from e
+    if tag & 0x1F == 0x1F:
+        raise ValueError("High tag number DER values are not supported")
+    off += 2
+    if length & 0x80:
+        num_octets = length & 0x7F
+        if not 0 < num_octets <= 4:
+            raise ValueError(f"Unsupported DER length encoding at offset {off - 1}")
+        length = int.from_bytes(buf[off:off + num_octets], "big")
+        off += num_octets
+    if off + length > len(buf):
+        raise ValueError(f"DER value at offset {off} overruns the buffer")
+    return tag, length, off, off + length
+
+
+def _der_select(buf, path):
+    """Walk nested constructed DER values by child index and return the content octets of the selected value
+
+    path mirrors pyasn1 indexing, e.g. (1, 0, 0, 1) selects the same value as decoded["field-1"][0][0][1]
+    """
+    tag, length, value_off, end = _read_tlv(buf, 0)
+    for index in path:
+        if not tag & 0x20:
+            raise ValueError("Cannot index into a primitive DER value")
+        off = value_off
+        for _ in range(index + 1):
+            if off >= end:
+                raise ValueError(f"DER value has no child at index {index}")
+            tag, length, value_off, off = _read_tlv(buf, off)
+        end = value_off + length
+    return bytes(buf[value_off:end])
+
+
+def _unpack_cms(cms_blob):
+    """Pull the KEK recipient and content encryption fields out of the LAPSv2 CMS blob with asn1crypto
+
+    Returns (key identifier, keyAttr DER, encrypted CEK, content encryption parameters DER, ciphertext)
+    """
+    from asn1crypto.cms import ContentInfo
+
+    # The ciphertext is appended after the DER encoded ContentInfo rather than embedded in it
+    _, _, _, cms_end = _read_tlv(cms_blob, 0)
+    enveloped_data = ContentInfo.load(cms_blob[:cms_end])["content"]
+    kek_recipient_info = enveloped_data["recipient_infos"][0].chosen
+    kek_identifier = kek_recipient_info["kekid"]
+    return (
+        kek_identifier["key_identifier"].native,
+        kek_identifier["other"]["key_attr"].dump(),
+        kek_recipient_info["encrypted_key"].native,
+        enveloped_data["encrypted_content_info"]["content_encryption_algorithm"]["parameters"].dump(),
+        cms_blob[cms_end:],
+    )
+
+
+@cache
+def _cms_specs():
+    """Build the pyasn1 ContentInfo and EnvelopedData schemas once, the decoder never mutates them"""
+    from pyasn1_modules import rfc5652
+
+    return rfc5652.ContentInfo(), rfc5652.EnvelopedData()
+
+
+def _unpack_cms_pyasn1(cms_blob):
+    """pyasn1 counterpart of _unpack_cms, for blobs asn1crypto cannot parse"""
+    from pyasn1.codec.der import decoder
+
+    content_info_spec, enveloped_data_spec = _cms_specs()
+    parsed_cms_data, remaining = decoder.decode(cms_blob, asn1Spec=content_info_spec)
+    parsed_enveloped_data, _ = _der_decode(parsed_cms_data["content"], asn1Spec=enveloped_data_spec)
+    kek_recipient_info = parsed_enveloped_data["recipientInfos"][0]["kekri"]
+    kek_identifier = kek_recipient_info["kekid"]
+    return (
+        bytes(kek_identifier["keyIdentifier"]),
+        bytes(kek_identifier["other"]["keyAttr"]),
+        bytes(kek_recipient_info["encryptedKey"]),
+        bytes(parsed_enveloped_data["encryptedContentInfo"]["contentEncryptionAlgorithm"]["parameters"]),
+        remaining,
+    )
+
 
 class LDAPConnect:
-    def __init__(self, host, port, hostname):
+    def __init__(self, host, port, hostname, max_pool_size=8):
         self.logger = None
+        self.max_pool_size = max_pool_size
+        # Keyed on the connection itself, so a connection that is never released does not keep its lease alive
+        self.leased = WeakKeyDictionary()
         self.proto_logger(host, port, hostname)
 
     def proto_logger(self, host, port, hostname):
         self.logger = NXCAdapter(extra={"protocol": "LDAP", "host": host, "port": port, "hostname": hostname})
 
+    def acquire(self, pool_key):
+        """Return a live pooled connection for pool_key, or None if there is none to reuse"""
+        with _LDAP_POOL_LOCK:
+            pool = _LDAP_POOL.get(pool_key)
+        if pool is None:
+            return None
+
+        while True:
+            try:
+                ldap_connection, protocol, port = pool.get_nowait()
+            except queue.Empty:
+                return None
+            # Idle sockets get dropped by the DC, so make sure the connection still answers before reusing it
+            try:
+                ldap_connection.search(searchBase="", scope=ldapasn1_impacket.Scope("baseObject"), attributes=["defaultNamingContext"], sizeLimit=1)
+            except Exception as e:
+                self.logger.debug("Dropping stale pooled LDAP connection: %s", e)
+                ldap_connection.close()
+                continue
+            self.logger.debug("Reusing pooled %s connection", protocol)
+            return self.connected(ldap_connection, pool_key, protocol, port)
+
+    def connected(self, ldap_connection, pool_key, protocol, port):
+        """Record a successfully authenticated connection so it can be released back to the pool"""
+        self.leased[ldap_connection] = (pool_key, protocol, port)
+        return ldap_connection, protocol, port
+
+    def use_connection(self, ldap_connection, protocol, port):
+        """Point the logger at the protocol and port of an authenticated connection"""
+        if ldap_connection:
+            self.logger.extra["protocol"] = protocol
+            self.logger.extra["port"] = port
+        return ldap_connection
+
+    def release(self, ldap_connection):
+        """Hand a connection returned by kerberos_login or auth_login back to the pool"""
+        lease = self.leased.pop(ldap_connection, None)
+        if lease is None:
+            return
+        pool_key, protocol, port = lease
+        with _LDAP_POOL_LOCK:
+            if pool_key not in _LDAP_POOL:
+                _LDAP_POOL[pool_key] = queue.Queue(maxsize=self.max_pool_size)
+            pool = _LDAP_POOL[pool_key]
+        try:
+            pool.put_nowait((ldap_connection, protocol, port))
+        except queue.Full:
+            ldap_connection.close()
+
+    def report_auth_failure(self, e, domain, username, secret):
+        """Report a rejected bind along with the account status decoded from the LDAP error"""
+        status, color = _ldap_error_status(str(e))
+        self.logger.fail(f"{domain}\\{username}:{secret} {status}", color=color)
+
     def kerberos_login(self, domain, username, password="", ntlm_hash="", aesKey="", kdcHost="", useCache=False, dns_server=""):
-        lmhash = ""
-        nthash = ""
+        """Bind to the DC with Kerberos and return the connection, or False on failure
+
+        A pooled connection for the same target and credential is returned as is, without binding again
+        """
+        return self.use_connection(*self.kerberos_connect(domain, username, password, ntlm_hash, aesKey, kdcHost, useCache, dns_server))
+
+    def auth_login(self, domain, username, password, ntlm_hash, dns_server):
+        """Bind to the DC with NTLM and return the connection, or False on failure
+
+        A pooled connection for the same target and credential is returned as is, without binding again
+        """
+        return self.use_connection(*self.auth_connect(domain, username, password, ntlm_hash, dns_server))
+
+    def login_many(self, creds, kerberos=False, max_workers=16):
+        """Check many credentials concurrently
+
+        Each entry of creds holds the positional arguments of kerberos_login (if kerberos is set) or auth_login.
+        Returns a (connection, protocol, port) tuple per entry, in order, with connection set to False on failure.
+        """
+        connect = self.kerberos_connect if kerberos else self.auth_connect
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda cred: connect(*cred), creds))
+
+    def kerberos_connect(self, domain, username, password="", ntlm_hash="", aesKey="", kdcHost="", useCache=False, dns_server=""):
+        """Same as kerberos_login, but returns (connection, protocol, port) instead of updating the shared logger"""
+        from impacket.krb5.kerberosv5 import KerberosError
 
         if kdcHost is None or domain not in kdcHost:
             self.logger.fail("Please provide the FQDN of the domain controller with --kdcHost")
             exit(1)
 
-        # This checks to see if we didn't provide the LM Hash
-        if ntlm_hash and ntlm_hash.find(":") != -1:
-            lmhash, nthash = ntlm_hash.split(":")
-        elif ntlm_hash:
-            nthash = ntlm_hash
+        pool_key = ("kerberos", kdcHost, dns_server, domain, username, password, ntlm_hash, aesKey)
+        pooled = self.acquire(pool_key)
+        if pooled is not None:
+            return pooled
 
-        # Create the baseDN
-        baseDN = ""
-        domainParts = domain.split(".")
-        for i in domainParts:
-            baseDN += f"DC={i},"
-        # Remove last ','
-        baseDN = baseDN[:-1]
+        lmhash, nthash = _parse_ntlm_hash(ntlm_hash)
+        baseDN = _base_dn(domain)
 
         try:
-            self.logger.info(f"Connecting to ldap://{kdcHost} - {baseDN} - {domain} [1]")
+            self.logger.info("Connecting to ldap://%s - %s - %s [1]", kdcHost, baseDN, domain)
             ldap_connection = ldap_impacket.LDAPConnection(f"ldap://{kdcHost}", baseDN, dns_server if dns_server else domain)
             ldap_connection.kerberosLogin(
                 username,
@@ -71,11 +333,9 @@ class LDAPConnect:
                 useCache=False,
             )
             # Connect to LDAP
-            self.logger.extra["protocol"] = "LDAP"
-            self.logger.extra["port"] = "389"
-            return ldap_connection
+            return self.connected(ldap_connection, pool_key, "LDAP", "389")
         except ldap_impacket.LDAPSessionError as e:
-            if str(e).find("strongerAuthRequired") >= 0:
+            if _stronger_auth_required(e):
                 # We need to try SSL
                 try:
                     ldap_connection = ldap_impacket.LDAPConnection(f"ldaps://{kdcHost}", baseDN, dns_server if dns_server else domain)
@@ -89,94 +349,61 @@ class LDAPConnect:
                         kdcHost=kdcHost,
                         useCache=False,
                     )
-                    self.logger.extra["protocol"] = "LDAPS"
-                    self.logger.extra["port"] = "636"
-                    return ldap_connection
+                    return self.connected(ldap_connection, pool_key, "LDAPS", "636")
                 except ldap_impacket.LDAPSessionError as e:
-                    error_code = str(e).split()[-2][:-1]
-                    self.logger.fail(
-                        f"{domain}\\{username}:{password if password else ntlm_hash} {ldap_error_status[error_code] if error_code in ldap_error_status else ''}",
-                        color="magenta" if error_code in ldap_error_status else "red",
-                    )
+                    self.report_auth_failure(e, domain, username, password if password else ntlm_hash)
             else:
-                error_code = str(e).split()[-2][:-1]
-                self.logger.fail(
-                    f"{domain}\\{username}:{password if password else ntlm_hash} {ldap_error_status[error_code] if error_code in ldap_error_status else ''}",
-                    color="magenta" if error_code in ldap_error_status else "red",
-                )
-            return False
+                self.report_auth_failure(e, domain, username, password if password else ntlm_hash)
+            return False, None, None
         except OSError:
-            self.logger.debug(f"{domain}\\{username}:{password if password else ntlm_hash} {'Error connecting to the domain, please add option --kdcHost with the FQDN of the domain controller'}")
-            return False
+            self.logger.debug("%s\\%s:%s Error connecting to the domain, please add option --kdcHost with the FQDN of the domain controller", domain, username, password if password else ntlm_hash)
+            return False, None, None
         except KerberosError as e:
             self.logger.fail(f"{domain}\\{username}:{password if password else ntlm_hash} {e!s}", color="red")
-            return False
+            return False, None, None
 
-    def auth_login(self, domain, username, password, ntlm_hash, dns_server):
-        lmhash = ""
-        nthash = ""
-
-        # This checks to see if we didn't provide the LM Hash
-        if ntlm_hash and ntlm_hash.find(":") != -1:
-            lmhash, nthash = ntlm_hash.split(":")
-        elif ntlm_hash:
-            nthash = ntlm_hash
-
-        # Create the baseDN
-        base_dn = ""
-        domain_parts = domain.split(".")
-        for i in domain_parts:
-            base_dn += f"dc={i},"
-        # Remove last ','
-        base_dn = base_dn[:-1]
+    def auth_connect(self, domain, username, password, ntlm_hash, dns_server):
+        """Same as auth_login, but returns (connection, protocol, port) instead of updating the shared logger"""
+        pool_key = ("ntlm", domain, dns_server, username, password, ntlm_hash)
+        pooled = self.acquire(pool_key)
+        if pooled is not None:
+            return pooled
+
+        lmhash, nthash = _parse_ntlm_hash(ntlm_hash)
+        base_dn = _base_dn(domain)
 
         try:
             ldap_connection = ldap_impacket.LDAPConnection(f"ldap://{domain}", base_dn, dns_server if dns_server else domain)
             ldap_connection.login(username, password, domain, lmhash, nthash)
 
             # Connect to LDAP
-            self.logger.extra["protocol"] = "LDAP"
-            self.logger.extra["port"] = "389"
-
-            return ldap_connection
+            return self.connected(ldap_connection, pool_key, "LDAP", "389")
 
         except ldap_impacket.LDAPSessionError as e:
-            if str(e).find("strongerAuthRequired") >= 0:
+            if _stronger_auth_required(e):
                 # We need to try SSL
                 try:
                     ldap_connection = ldap_impacket.LDAPConnection(f"ldaps://{domain}", base_dn, dns_server if dns_server else domain)
                     ldap_connection.login(username, password, domain, lmhash, nthash)
-                    self.logger.extra["protocol"] = "LDAPS"
-                    self.logger.extra["port"] = "636"
-                    return ldap_connection
+                    return self.connected(ldap_connection, pool_key, "LDAPS", "636")
                 except ldap_impacket.LDAPSessionError as e:
-                    error_code = str(e).split()[-2][:-1]
-                    self.logger.fail(
-                        f"{domain}\\{username}:{password if password else ntlm_hash} {ldap_error_status[error_code] if error_code in ldap_error_status else ''}",
-                        color="magenta" if error_code in ldap_error_status else "red",
-                    )
+                    self.report_auth_failure(e, domain, username, password if password else ntlm_hash)
             else:
-                error_code = str(e).split()[-2][:-1]
-                self.logger.fail(
-                    f"{domain}\\{username}:{password if password else ntlm_hash} {ldap_error_status[error_code] if error_code in ldap_error_status else ''}",
-                    color="magenta" if error_code in ldap_error_status else "red",
-                )
-            return False
+                self.report_auth_failure(e, domain, username, password if password else ntlm_hash)
+            return False, None, None
 
         except OSError:
-            self.logger.debug(f"{domain}\\{username}:{password if password else ntlm_hash} {'Error connecting to the domain, please add option --kdcHost with the FQDN of the domain controller'}")
-            return False
+            self.logger.debug("%s\\%s:%s Error connecting to the domain, please add option --kdcHost with the FQDN of the domain controller", domain, username, password if password else ntlm_hash)
+            return False, None, None
 
 
-class LAPSv2Extract:
-    def __init__(self, data, username, password, domain, ntlm_hash, do_kerberos, kdcHost, port, dns_server):
-        if ntlm_hash.find(":") != -1:
-            self.lmhash, self.nthash = ntlm_hash.split(":")
-        else:
-            self.nthash = ntlm_hash
-            self.lmhash = ""
-
-        self.data = data
+class LAPSv2BatchExtract:
+    def __init__(self, username, password, domain, ntlm_hash, do_kerberos, kdcHost, port, dns_server):
+        self.lmhash, self.nthash = _parse_ntlm_hash(ntlm_hash)
+        self.gke_cache = {}
+        self.l2_key_cache = {}
+        # Set once connecting or binding to MS-GKDI failed, so the rest of the batch does not retry an unreachable DC
+        self.gkdi_failed = False
         self.username = username
         self.password = password
         self.domain = domain
@@ -189,75 +416,233 @@ class LAPSv2Extract:
     def proto_logger(self, host, port, hostname):
         self.logger = NXCAdapter(extra={"protocol": "LDAP", "host": host, "port": port, "hostname": hostname})
 
-    def run(self):
-        kds_cache = {}
-        self.logger.info("[-] Unpacking blob")
+    def gkdi_cache_key(self):
+        return (self.dns_server if self.dns_server else self.domain, self.domain, self.username, self.password, self.lmhash, self.nthash, self.do_kerberos, self.kdcHost)
+
+    def rpc_connect(self):
+        """Return a bound MS-GKDI connection to the domain controller and its lock, reusing a cached one when possible"""
+        from impacket.dcerpc.v5.gkdi import MSRPC_UUID_GKDI
+        from impacket.dcerpc.v5.rpcrt import RPC_C_AUTHN_LEVEL_PKT_PRIVACY
+
+        cache_key = self.gkdi_cache_key()
+        with _GKDI_DCE_CACHE_LOCK:
+            cached = _GKDI_DCE_CACHE.get(cache_key)
+        if cached is not None:
+            self.logger.info("Reusing bound MS-GKDI connection")
+            return cached
+        if self.gkdi_failed:
+            self.logger.debug("Skipping MS-GKDI GetKey, the connection to the domain controller already failed")
+            return None
+
+        # Connect on RPC over TCP to MS-GKDI to call opnum 0 GetKey
         try:
-            encrypted_laps_blob = EncryptedPasswordBlob(self.data)
-            parsed_cms_data, remaining = decoder.decode(encrypted_laps_blob["Blob"], asn1Spec=rfc5652.ContentInfo())
-            enveloped_data_blob = parsed_cms_data["content"]
-            parsed_enveloped_data, _ = decoder.decode(enveloped_data_blob, asn1Spec=rfc5652.EnvelopedData())
-
-            recipient_infos = parsed_enveloped_data["recipientInfos"]
-            kek_recipient_info = recipient_infos[0]["kekri"]
-            kek_identifier = kek_recipient_info["kekid"]
-            key_id = KeyIdentifier(bytes(kek_identifier["keyIdentifier"]))
-            tmp, _ = decoder.decode(kek_identifier["other"]["keyAttr"])
-            sid = tmp["field-1"][0][0][1].asOctets().decode("utf-8")
-            target_sd = create_sd(sid)
+            string_binding = _cached_hept_map(cache_key[0], MSRPC_UUID_GKDI)
         except Exception as e:
-            self.logger.error(f"Cannot unpack msLAPS-EncryptedPassword blob due to error {e}")
+            self.logger.error("Something went wrong, check error status => %s", e)
+            self.gkdi_failed = True
             return None
+        if self.do_kerberos:
+            self.logger.info("Connecting using kerberos")
+        rpc_transport = _build_transport(string_binding, self.username, self.password, self.domain, self.lmhash, self.nthash, self.do_kerberos, self.kdcHost)
 
-        # Check if item is in cache
-        if key_id["RootKeyId"] in kds_cache:
-            self.logger.info("Got KDS from cache")
-            gke = kds_cache[key_id["RootKeyId"]]
-        else:
-            # Connect on RPC over TCP to MS-GKDI to call opnum 0 GetKey
-            string_binding = hept_map(destHost=self.domain if not self.dns_server else self.dns_server, remoteIf=MSRPC_UUID_GKDI, protocol="ncacn_ip_tcp")
-            rpc_transport = transport.DCERPCTransportFactory(string_binding)
-            if hasattr(rpc_transport, "set_credentials"):
-                rpc_transport.set_credentials(username=self.username, password=self.password, domain=self.domain, lmhash=self.lmhash, nthash=self.nthash)
-            if self.do_kerberos:
-                self.logger.info("Connecting using kerberos")
-                rpc_transport.set_kerberos(self.do_kerberos, kdcHost=self.kdcHost)
-
-            dce = rpc_transport.get_dce_rpc()
-            dce.set_auth_level(RPC_C_AUTHN_LEVEL_PKT_INTEGRITY)
-            dce.set_auth_level(RPC_C_AUTHN_LEVEL_PKT_PRIVACY)
-            self.logger.info(f"Connecting to {string_binding}")
+        dce = rpc_transport.get_dce_rpc()
+        dce.set_auth_level(RPC_C_AUTHN_LEVEL_PKT_PRIVACY)
+        self.logger.info("Connecting to %s", string_binding)
+        try:
+            dce.connect()
+        except Exception as e:
+            self.logger.error("Something went wrong, check error status => %s", e)
+            self.gkdi_failed = True
+            return None
+        self.logger.info("Connected")
+        try:
+            dce.bind(MSRPC_UUID_GKDI)
+        except Exception as e:
+            self.logger.debug(traceback.format_exc())
+            self.logger.error("Something went wrong, check error status => %s", e)
+            self.gkdi_failed = True
+            dce.disconnect()
+            return None
+        self.logger.info("Successfully bound")
+
+        with _GKDI_DCE_CACHE_LOCK:
+            cached = _GKDI_DCE_CACHE.setdefault(cache_key, (dce, threading.Lock()))
+        if cached[0] is not dce:
+            # Another thread bound a connection for the same target and credential first
+            dce.disconnect()
+        return cached
+
+    def evict(self, dce):
+        """Drop a dead MS-GKDI connection from the cache, along with the endpoint it was resolved from"""
+        cache_key = self.gkdi_cache_key()
+        with _GKDI_DCE_CACHE_LOCK:
+            if cache_key in _GKDI_DCE_CACHE and _GKDI_DCE_CACHE[cache_key][0] is dce:
+                del _GKDI_DCE_CACHE[cache_key]
+        with suppress(Exception):
+            dce.disconnect()
+        # The dynamic endpoint may have moved, e.g. after the DC rebooted
+        _cached_hept_map.cache_clear()
+
+    def get_key(self, target_sd, key_id):
+        """Call MS-GKDI GetKey for key_id, reconnecting once if a reused connection was dropped"""
+        from impacket.dcerpc.v5.gkdi import GkdiGetKey
+
+        for _ in range(2):
+            with _GKDI_DCE_CACHE_LOCK:
+                reused = self.gkdi_cache_key() in _GKDI_DCE_CACHE
+            cached = self.rpc_connect()
+            if cached is None:
+                return None
+            dce, dce_lock = cached
+            self.logger.info("Calling MS-GKDI GetKey")
             try:
-                dce.connect()
+                with dce_lock:
+                    return GkdiGetKey(dce, target_sd=target_sd, l0=key_id["L0Index"], l1=key_id["L1Index"], l2=key_id["L2Index"], root_key_id=key_id["RootKeyId"])
             except Exception as e:
-                self.logger.error(f"Something went wrong, check error status => {e}")
-                return False
-            self.logger.info("Connected")
+                if not _is_transport_failure(e):
+                    raise
+                self.evict(dce)
+                if not reused:
+                    raise
+                self.logger.info("MS-GKDI GetKey failed on a reused connection, reconnecting: %s", e)
+
+    def unpack_blob(self, data):
+        """Parse a msLAPS-EncryptedPassword blob into the pieces needed to fetch its key and decrypt it"""
+        from pyasn1.codec.der import decoder
+        from impacket.dpapi_ng import EncryptedPasswordBlob, KeyIdentifier
+
+        self.logger.info("[-] Unpacking blob")
+        try:
+            cms_blob = EncryptedPasswordBlob(data)["Blob"]
             try:
-                dce.bind(MSRPC_UUID_GKDI)
+                key_id_raw, key_attr, encrypted_key, enc_content_parameter, remaining = _unpack_cms(cms_blob)
             except Exception as e:
-                self.logger.error(f"Something went wrong, check error status => {e!s}")
-                return False
-            self.logger.info("Successfully bound")
-            self.logger.info("Calling MS-GKDI GetKey")
+                self.logger.debug("asn1crypto could not parse the CMS blob, falling back to pyasn1: %s", e)
+                key_id_raw, key_attr, encrypted_key, enc_content_parameter, remaining = _unpack_cms_pyasn1(cms_blob)
+            key_id = KeyIdentifier(key_id_raw)
+            try:
+                sid = _der_select(key_attr, (1, 0, 0, 1)).decode("utf-8")
+            except ValueError:
+                tmp, _ = decoder.decode(key_attr)
+                sid = tmp["field-1"][0][0][1].asOctets().decode("utf-8")
 
-            resp = GkdiGetKey(dce, target_sd=target_sd, l0=key_id["L0Index"], l1=key_id["L1Index"], l2=key_id["L2Index"], root_key_id=key_id["RootKeyId"])
-            self.logger.info("Decrypting password")
-            # Unpack GroupKeyEnvelope
-            gke = GroupKeyEnvelope(b"".join(resp["pbbOut"]))
-            kds_cache[gke["RootKeyId"]] = gke
+            # GCMParameters ::= SEQUENCE { aes-nonce OCTET STRING, aes-ICVlen INTEGER DEFAULT 12 }
+            try:
+                iv = _der_select(enc_content_parameter, (0,))
+            except ValueError:
+                iv, _ = decoder.decode(enc_content_parameter)
+                iv = bytes(iv[0])
+        except Exception as e:
+            self.logger.error("Cannot unpack msLAPS-EncryptedPassword blob due to error %s", e)
+            return None
 
-        kek = compute_kek(gke, key_id)
-        self.logger.info(f"KEK:\t{kek}")
-        enc_content_parameter = bytes(parsed_enveloped_data["encryptedContentInfo"]["contentEncryptionAlgorithm"]["parameters"])
-        iv, _ = decoder.decode(enc_content_parameter)
-        iv = bytes(iv[0])
+        return {
+            "key_id": key_id,
+            "sid": sid,
+            "encrypted_key": encrypted_key,
+            "iv": iv,
+            "remaining": remaining,
+        }
+
+    def key_cache_key(self, blob):
+        key_id = blob["key_id"]
+        return (key_id["RootKeyId"], key_id["L0Index"], key_id["L1Index"], key_id["L2Index"], blob["sid"])
+
+    def group_key(self, blob):
+        """Return the GroupKeyEnvelope protecting blob, calling MS-GKDI GetKey only for keys not seen yet"""
+        from impacket.dcerpc.v5.gkdi import GroupKeyEnvelope
+        from impacket.dpapi_ng import create_sd
+
+        key_id = blob["key_id"]
+        gke_cache_key = self.key_cache_key(blob)
+        if gke_cache_key in self.gke_cache:
+            self.logger.info("Got KDS from cache")
+            return self.gke_cache[gke_cache_key]
 
-        cek = unwrap_cek(kek, bytes(kek_recipient_info["encryptedKey"]))
-        self.logger.info(f"CEK:\t{cek}")
-        plaintext = decrypt_plaintext(cek, iv, remaining)
-        self.logger.info(plaintext[:-18].decode("utf-16le"))
-        return plaintext[:-18].decode("utf-16le")
+        resp = self.get_key(create_sd(blob["sid"]), key_id)
+        if resp is None:
+            return None
+        # Unpack GroupKeyEnvelope
+        gke = GroupKeyEnvelope(b"".join(resp["pbbOut"]))
+        self.gke_cache[gke_cache_key] = gke
+        return gke
+
+    def l2_key(self, gke, blob):
+        """Return (hash name, L2 key, DH private key) for the group key of blob, deriving them once per group key"""
+        from impacket.dpapi_ng import KDS_SERVICE_LABEL, compute_l2_key, kdf
+
+        l2_key_cache_key = self.key_cache_key(blob)
+        if l2_key_cache_key not in self.l2_key_cache:
+            hash_name = gke["KdfPara"]["HashName"].decode("utf-16le")
+            l2_key = compute_l2_key(blob["key_id"], gke)
+            private_key = kdf(hash_name, l2_key, KDS_SERVICE_LABEL, gke["SecAlgo"], math.ceil(gke["PrivKeyLength"] / 8))
+            self.l2_key_cache[l2_key_cache_key] = (hash_name, l2_key, private_key)
+        return self.l2_key_cache[l2_key_cache_key]
+
+    def derive_kek(self, gke, blob):
+        """Same as impacket's compute_kek, but reuses the L0/L1/L2 derivation across blobs sharing a group key
+
+        Only the DH exchange with the encryptor's public key and the final KDF are specific to each blob
+        """
+        from impacket.dpapi_ng import KDS_SERVICE_LABEL, FFCDHKey, compute_kdf_hash, kdf
+
+        hash_name, l2_key, private_key = self.l2_key(gke, blob)
+        key_id = blob["key_id"]
+        if not key_id.is_public_key():
+            return kdf(hash_name, l2_key, KDS_SERVICE_LABEL, key_id["Unknown"], 32)
+
+        sec_algo = gke["SecAlgo"].decode("utf-16le").rstrip("\0")
+        if sec_algo != "DH":
+            raise ValueError(f"Unsupported key agreement algorithm {sec_algo}")
+        dh_key = FFCDHKey(key_id["Unknown"])
+        shared_secret = pow(int.from_bytes(dh_key["PubKey"], "big"), int.from_bytes(private_key, "big"), int.from_bytes(dh_key["FieldOrder"], "big"))
+        shared_secret = shared_secret.to_bytes((shared_secret.bit_length() + 7) // 8, "big")
+        kek_context = "KDS public key\0".encode("utf-16le")
+        kek_secret = compute_kdf_hash(length=32, key_material=shared_secret, otherinfo="SHA512\0".encode("utf-16le") + kek_context + KDS_SERVICE_LABEL)
+        return kdf(hash_name, kek_secret, KDS_SERVICE_LABEL, kek_context, 32)
+
+    def decrypt_blob(self, gke, blob):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        from cryptography.hazmat.primitives.keywrap import aes_key_unwrap
+
+        self.logger.info("Decrypting password")
+        kek = self.derive_kek(gke, blob)
+        self.logger.info("KEK:\t%s", kek)
+        cek = aes_key_unwrap(kek, blob["encrypted_key"])
+        self.logger.info("CEK:\t%s", cek)
+        # The ciphertext ends with the 16 bytes GCM tag, which AESGCM verifies and strips
+        plaintext = AESGCM(cek).decrypt(blob["iv"], bytes(blob["remaining"]), None)
+        # Drop the UTF-16 NUL terminator without copying the plaintext first
+        password = str(memoryview(plaintext)[:-2], "utf-16le")
+        self.logger.info(password)
+        return password
+
+    def decrypt_many(self, blobs):
+        """Decrypt msLAPS-EncryptedPassword blobs over a single MS-GKDI connection
+
+        Returns the decrypted JSON string for each blob, in order, or None for the blobs that could not be decrypted
+        """
+        passwords = []
+        for blob in map(self.unpack_blob, blobs):
+            if blob is None:
+                passwords.append(None)
+                continue
+            try:
+                gke = self.group_key(blob)
+                passwords.append(self.decrypt_blob(gke, blob) if gke is not None else None)
+            except Exception as e:
+                self.logger.fail(f"Cannot decrypt msLAPS-EncryptedPassword blob due to error {e}")
+                passwords.append(None)
+        return passwords
+
+
+class LAPSv2Extract(LAPSv2BatchExtract):
+    def __init__(self, data, username, password, domain, ntlm_hash, do_kerberos, kdcHost, port, dns_server):
+        super().__init__(username, password, domain, ntlm_hash, do_kerberos, kdcHost, port, dns_server)
+        self.data = data
+
+    def run(self):
+        return self.decrypt_many([self.data])[0]
 
 
 def laps_search(self, username, password, cred_type, domain, dns_server):
@@ -303,13 +688,12 @@ def laps_search(self, username, password, cred_type, domain, dns_server):
         "sAMAccountName",
     ]
     results = connection.search(searchFilter=search_filter, attributes=attributes, sizeLimit=0)
+    ldapco.release(connection)
 
     msMCSAdmPwd = ""
     sAMAccountName = ""
     username_laps = ""
 
-    from impacket.ldap import ldapasn1 as ldapasn1_impacket
-
     results = [r for r in results if isinstance(r, ldapasn1_impacket.SearchResultEntry)]
     if len(results) != 0:
         for host in results:
@@ -327,10 +711,8 @@ def laps_search(self, username, password, cred_type, domain, dns_server):
                     339,
                     dns_server
                 )
-                try:
-                    data = d.run()
-                except Exception as e:
-                    self.logger.fail(str(e))
+                data = d.run()
+                if data is None:
                     return None, None, None
                 r = loads(data)
                 msMCSAdmPwd = r["p"]
@@ -343,7 +725,7 @@ def laps_search(self, username, password, cred_type, domain, dns_server):
                 msMCSAdmPwd = str(values["ms-mcs-admpwd"])
             else:
                 self.logger.fail("No result found with attribute ms-MCS-AdmPwd or msLAPS-Password")
-        self.logger.debug(f"Host: {sAMAccountName:<20} Password: {msMCSAdmPwd} {self.hostname}")
+        self.logger.debug("Host: %-20s Password: %s %s", sAMAccountName, msMCSAdmPwd, self.hostname)
     else:
         self.logger.fail(f"msMCSAdmPwd or msLAPS-Password is empty or account cannot read LAPS property for {self.hostname}")
         return None, None, None
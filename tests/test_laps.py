@@ -0,0 +1,353 @@
+import json
+import struct
+import time
+
+import pytest
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.keywrap import aes_key_wrap
+from pyasn1.codec.der import encoder
+from pyasn1.type import univ
+
+from nxc.protocols.ldap import laps
+from nxc.protocols.ldap.laps import LAPSv2BatchExtract, LDAPConnect, _der_select, _ldap_error_status, _read_tlv, _unpack_cms, _unpack_cms_pyasn1
+
+SID = "S-1-5-21-1004336348-1177238915-682003330-512"
+KEK = bytes(range(32))
+CEK = bytes(range(32, 64))
+NONCE = bytes(range(12))
+PASSWORD = {"n": "Administrator", "t": "1d9d8b6c8e7f0a0", "p": "Sup3r-S3cret!"}
+
+
+def der(tag, content):
+    length = len(content)
+    if length < 0x80:
+        return bytes([tag, length]) + content
+    length_octets = length.to_bytes((length.bit_length() + 7) // 8, "big")
+    return bytes([tag, 0x80 | len(length_octets)]) + length_octets + content
+
+
+def oid(dotted):
+    return encoder.encode(univ.ObjectIdentifier(dotted))
+
+
+def key_identifier(l0=361, public_key=b""):
+    domain = "contoso.local\0".encode("utf-16le")
+    header = struct.pack("<LLLLLL16sLLL", 1, 0x4B53444B, int(bool(public_key)), l0, 31, 2, bytes(range(16)), len(public_key), len(domain), len(domain))
+    return header + public_key + domain + domain
+
+
+def dh_public_key(private_key):
+    """Encode a FFC DH public key the way it is stored in a public key identifier, over a toy 128 bits group"""
+    field_order = 2**127 - 1
+    return b"DHPB" + struct.pack("<L", 16) + field_order.to_bytes(16, "big") + (2).to_bytes(16, "big") + pow(2, private_key, field_order).to_bytes(16, "big")
+
+
+def make_blob(l0=361, password=PASSWORD, public_key=b""):
+    """Build a msLAPS-EncryptedPassword blob the same way a DC does, with KEK standing in for the GKDI derived key"""
+    sid_attr = der(0x30, der(0x0C, b"SID") + der(0x0C, SID.encode()))
+    key_attr = der(0x30, der(0x0C, b"1.3.6.1.4.1.311.74.1.1") + der(0x30, der(0x30, sid_attr)))
+    kekid = der(0x30, der(0x04, key_identifier(l0, public_key)) + der(0x30, oid("1.3.6.1.4.1.311.74.1") + key_attr))
+    kekri = der(0xA2, der(0x02, b"\x04") + kekid + der(0x30, oid("2.16.840.1.101.3.4.1.45")) + der(0x04, aes_key_wrap(KEK, CEK)))
+    gcm_parameters = der(0x30, der(0x04, NONCE) + der(0x02, b"\x10"))
+    encrypted_content_info = der(0x30, oid("1.2.840.113549.1.7.1") + der(0x30, oid("2.16.840.1.101.3.4.1.46") + gcm_parameters))
+    enveloped_data = der(0x30, der(0x02, b"\x02") + der(0x31, kekri) + encrypted_content_info)
+    content_info = der(0x30, oid("1.2.840.113549.1.7.3") + der(0xA0, enveloped_data))
+
+    plaintext = json.dumps(password).encode("utf-16le") + b"\0\0"
+    cms = content_info + AESGCM(CEK).encrypt(NONCE, plaintext, None)
+    return struct.pack("<LLLL", 0x01DA0B3C, 0x2E1B7A90, len(cms), 0) + cms
+
+
+def extractor():
+    return LAPSv2BatchExtract("user", "Passw0rd!", "contoso.local", "", False, "", 135, "")
+
+
+@pytest.fixture(autouse=True)
+def _clear_caches():
+    laps._LDAP_POOL.clear()
+    laps._GKDI_DCE_CACHE.clear()
+    laps._cached_hept_map.cache_clear()
+    yield
+    laps._LDAP_POOL.clear()
+    laps._GKDI_DCE_CACHE.clear()
+    laps._cached_hept_map.cache_clear()
+
+
+@pytest.fixture()
+def _fake_kek(monkeypatch):
+    monkeypatch.setattr(LAPSv2BatchExtract, "derive_kek", lambda self, gke, blob: KEK)
+
+
+def test_unpack_blob_selects_sid_and_iv():
+    blob = extractor().unpack_blob(make_blob())
+    assert blob["sid"] == SID
+    assert blob["iv"] == NONCE
+    assert blob["key_id"]["L0Index"] == 361
+    assert not blob["key_id"].is_public_key()
+
+
+def test_asn1crypto_and_pyasn1_agree():
+    cms = make_blob()[16:]
+    assert _unpack_cms(cms) == _unpack_cms_pyasn1(cms)
+
+
+def test_read_tlv_long_form_length():
+    assert _read_tlv(b"\x04\x03abc", 0) == (4, 3, 2, 5)
+    assert _read_tlv(b"\x04\x81\x03abc", 0) == (4, 3, 3, 6)
+    assert _read_tlv(b"\x04\x82\x00\x03abc", 0) == (4, 3, 4, 7)
+
+
+@pytest.mark.parametrize(
+    ("buf", "match"),
+    [
+        (b"", "Truncated"),
+        (b"\x04", "Truncated"),
+        (b"\x04\x05abc", "overruns"),
+        (b"\x04\x81\x05abc", "overruns"),
+        (b"\x04\x80abc", "length encoding"),
+        (b"\x04\x85\x00\x00\x00\x00\x03abc", "length encoding"),
+        (b"\x1f\x01a", "High tag number"),
+    ],
+)
+def test_read_tlv_rejects_malformed_headers(buf, match):
+    with pytest.raises(ValueError, match=match):
+        _read_tlv(buf, 0)
+
+
+def test_der_select_child_index_out_of_range():
+    buf = der(0x30, der(0x04, b"a") + der(0x30, der(0x04, b"b")))
+    assert _der_select(buf, (1, 0)) == b"b"
+    with pytest.raises(ValueError, match="no child at index 2"):
+        _der_select(buf, (2,))
+    with pytest.raises(ValueError, match="no child at index 1"):
+        _der_select(buf, (1, 1))
+    with pytest.raises(ValueError, match="primitive"):
+        _der_select(buf, (0, 0))
+
+
+@pytest.mark.usefixtures("_fake_kek")
+def test_decrypt_blob_round_trip():
+    extract = extractor()
+    blob = extract.unpack_blob(make_blob())
+    assert json.loads(extract.decrypt_blob(object(), blob)) == PASSWORD
+
+
+@pytest.mark.usefixtures("_fake_kek")
+def test_decrypt_blob_rejects_tampered_tag():
+    data = bytearray(make_blob())
+    data[-1] ^= 0x01
+    extract = extractor()
+    blob = extract.unpack_blob(bytes(data))
+    with pytest.raises(InvalidTag):
+        extract.decrypt_blob(object(), blob)
+
+
+def test_derive_kek_shares_l2_key_across_public_keys(monkeypatch):
+    import impacket.dpapi_ng
+
+    l2_key_calls = []
+
+    def compute_l2_key(key_id, gke):
+        l2_key_calls.append(key_id["L2Index"])
+        return bytes(range(64))
+
+    monkeypatch.setattr(impacket.dpapi_ng, "compute_l2_key", compute_l2_key)
+    gke = {"KdfPara": {"HashName": "SHA512\0".encode("utf-16le")}, "SecAlgo": "DH\0".encode("utf-16le"), "PrivKeyLength": 512}
+
+    extract = extractor()
+    blobs = [extract.unpack_blob(make_blob(public_key=dh_public_key(private_key))) for private_key in (3, 5)]
+    keks = [extract.derive_kek(gke, blob) for blob in blobs]
+
+    blobs.append(extract.unpack_blob(make_blob()))
+    keks.append(extract.derive_kek(gke, blobs[-1]))
+
+    assert len(l2_key_calls) == 1
+    assert len(set(keks)) == 3
+    assert keks == [impacket.dpapi_ng.compute_kek(gke, blob["key_id"]) for blob in blobs]
+
+
+class FakeDCE:
+    def __init__(self, calls, fail=None):
+        self.calls = calls
+        self.fail = fail
+
+    def set_auth_level(self, level):
+        pass
+
+    def connect(self):
+        self.calls["connect"] += 1
+        if self.fail == "connect":
+            raise OSError("Connection timed out")
+
+    def bind(self, uuid):
+        if self.fail == "bind":
+            raise OSError("Connection reset by peer")
+
+    def disconnect(self):
+        self.calls["disconnect"] += 1
+
+
+class FakeTransport:
+    def __init__(self, calls, fail=None):
+        self.calls = calls
+        self.fail = fail
+
+    def get_dce_rpc(self):
+        return FakeDCE(self.calls, self.fail)
+
+
+@pytest.mark.usefixtures("_fake_kek")
+def test_denied_blob_keeps_cached_connection(monkeypatch):
+    from impacket.dcerpc.v5.gkdi import DCERPCSessionError
+
+    calls = {"connect": 0, "disconnect": 0}
+
+    def get_key(dce, target_sd, l0, l1, l2, root_key_id):
+        if l0 == 1:
+            raise DCERPCSessionError(error_code=0x80070005)
+        return {"pbbOut": [b"group key envelope"]}
+
+    monkeypatch.setattr("impacket.dcerpc.v5.epm.hept_map", lambda destHost, remoteIf, protocol: "ncacn_ip_tcp:10.0.0.1[49667]")
+    monkeypatch.setattr(laps, "_build_transport", lambda *args: FakeTransport(calls))
+    monkeypatch.setattr("impacket.dcerpc.v5.gkdi.GkdiGetKey", get_key)
+    monkeypatch.setattr("impacket.dcerpc.v5.gkdi.GroupKeyEnvelope", bytes)
+
+    extract = extractor()
+    passwords = extract.decrypt_many([make_blob(l0=1), make_blob(l0=2)])
+
+    assert passwords[0] is None
+    assert json.loads(passwords[1]) == PASSWORD
+    assert calls == {"connect": 1, "disconnect": 0}
+    assert len(laps._GKDI_DCE_CACHE) == 1
+
+
+
+@pytest.mark.parametrize("fail", ["hept_map", "connect", "bind"])
+def test_unreachable_dc_is_tried_once_per_batch(monkeypatch, fail):
+    calls = {"hept_map": 0, "connect": 0, "disconnect": 0, "get_key": 0}
+
+    def hept_map(destHost, remoteIf, protocol):
+        calls["hept_map"] += 1
+        if fail == "hept_map":
+            raise OSError("Connection timed out")
+        return "ncacn_ip_tcp:10.0.0.1[49667]"
+
+    def get_key(*args, **kwargs):
+        calls["get_key"] += 1
+
+    monkeypatch.setattr("impacket.dcerpc.v5.epm.hept_map", hept_map)
+    monkeypatch.setattr(laps, "_build_transport", lambda *args: FakeTransport(calls, fail))
+    monkeypatch.setattr("impacket.dcerpc.v5.gkdi.GkdiGetKey", get_key)
+
+    passwords = extractor().decrypt_many([make_blob(l0=l0) for l0 in (1, 2, 3)])
+
+    assert passwords == [None, None, None]
+    assert calls["hept_map"] == 1
+    assert calls["connect"] == (0 if fail == "hept_map" else 1)
+    assert calls["get_key"] == 0
+    assert not laps._GKDI_DCE_CACHE
+
+
+
+@pytest.mark.parametrize(
+    ("error_string", "expected"),
+    [
+        ("Error in bindRequest -> invalidCredentials: 80090308: LdapErr: DSID-0C09044E, comment: AcceptSecurityContext error, data 775, v4563", ("USER_ACCOUNT_LOCKED", "magenta")),
+        ("Error in bindRequest -> invalidCredentials: 80090308: LdapErr: DSID-0C09044E, comment: AcceptSecurityContext error, data 533, v4563", ("STATUS_ACCOUNT_DISABLED", "magenta")),
+        ("Error in bindRequest -> invalidCredentials: 80090308: LdapErr: DSID-0C09044E, comment: AcceptSecurityContext error, data 52e, v4563", ("", "red")),
+        ("Error in bindRequest -> invalidCredentials: 80090308: LdapErr: DSID-0C09044E, comment: AcceptSecurityContext error, data 0775, v4563", ("USER_ACCOUNT_LOCKED", "magenta")),
+        ("Error in bindRequest -> insufficientAccessRights: 00000005: LdapErr: DSID-0C090A37, comment: Error processing control, data 50, v4563", ("LDAP_INSUFFICIENT_ACCESS", "magenta")),
+        ("Kerberos SessionError: KDC_ERR_PREAUTH_FAILED, Pre-authentication", ("KDC_ERR_PREAUTH_FAILED", "magenta")),
+        ("Kerberos SessionError: KDC_ERR_C_PRINCIPAL_UNKNOWN, Client", ("", "red")),
+    ],
+)
+def test_ldap_error_status(error_string, expected):
+    assert _ldap_error_status(error_string) == expected
+
+
+class FakeLDAPConnection:
+    def __init__(self, url, base_dn, dst_ip):
+        self.url = url
+        self.alive = True
+        self.closed = False
+        self.logins = 0
+
+    def login(self, user, password, domain, lmhash, nthash):
+        self.logins += 1
+
+    def search(self, **kwargs):
+        if not self.alive:
+            raise OSError("Connection reset by peer")
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture()
+def ldapco(monkeypatch):
+    monkeypatch.setattr(laps.ldap_impacket, "LDAPConnection", FakeLDAPConnection)
+    return LDAPConnect("dc01.contoso.local", 389, "DC01", max_pool_size=1)
+
+
+def login(ldapco):
+    return ldapco.auth_login("contoso.local", "user", "Passw0rd!", "", "")
+
+
+def test_released_connection_is_reused(ldapco):
+    connection = login(ldapco)
+    ldapco.release(connection)
+    assert login(ldapco) is connection
+    assert connection.logins == 1
+    assert not connection.closed
+
+
+def test_stale_pooled_connection_is_closed_and_skipped(ldapco):
+    connection = login(ldapco)
+    ldapco.release(connection)
+    connection.alive = False
+    assert login(ldapco) is not connection
+    assert connection.closed
+
+
+def test_release_beyond_max_pool_size_closes_connection(ldapco):
+    first, second = login(ldapco), login(ldapco)
+    ldapco.release(first)
+    ldapco.release(second)
+    assert not first.closed
+    assert second.closed
+
+
+def test_release_of_unleased_connection_is_ignored(ldapco):
+    connection = FakeLDAPConnection("ldap://contoso.local", "dc=contoso,dc=local", "contoso.local")
+    ldapco.release(connection)
+    assert not connection.closed
+    assert not laps._LDAP_POOL
+    assert login(ldapco) is not connection
+
+
+@pytest.mark.parametrize("kerberos", [False, True])
+def test_login_many_keeps_order_and_logger(monkeypatch, kerberos):
+    calls = []
+
+    def make_connect(protocol):
+        def connect(domain, username, *args):
+            # Finish in reverse order of submission, so results only come back in order if login_many keeps it
+            time.sleep(0.01 * (3 - int(username[-1])))
+            calls.append((protocol, username))
+            return f"{protocol}:{username}", protocol, "389"
+
+        return connect
+
+    ldapco = LDAPConnect("dc01.contoso.local", 389, "DC01")
+    monkeypatch.setattr(ldapco, "auth_connect", make_connect("ntlm"))
+    monkeypatch.setattr(ldapco, "kerberos_connect", make_connect("kerberos"))
+    extra = dict(ldapco.logger.extra)
+
+    creds = [("contoso.local", f"user{i}", "Passw0rd!") for i in range(3)]
+    results = ldapco.login_many(creds, kerberos=kerberos)
+
+    protocol = "kerberos" if kerberos else "ntlm"
+    assert results == [(f"{protocol}:user{i}", protocol, "389") for i in range(3)]
+    assert {call[0] for call in calls} == {protocol}
+    assert ldapco.logger.extra == extra